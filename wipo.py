@@ -1,14 +1,74 @@
-import time
 import sys
 import csv
 from DrissionPage import ChromiumPage
-from parsel import Selector
+import lxml.html
+from lxml import etree
+from cssselect import GenericTranslator
 import os
+import atexit
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from queue import Queue, Empty
 
 # 配置常量
 DEFAULT_IPC = 'A23P20/17'
 URL = 'https://patentscope.wipo.int/search/zh/search.jsf'
 PAGE_LIMIT = 200
+SAVE_BATCH_SIZE = 1000
+POOL_SIZE = 4
+TAB_RECYCLE_AFTER = 100
+# 等空闲标签页的最长时间, 超时说明浏览器已经不可用, 直接结束运行
+POOL_ACQUIRE_TIMEOUT = 600
+# 连续这么多个IPC失败就停止运行 (多半是断网或被限流), 免得把整个列表都挪进日志
+MAX_CONSECUTIVE_FAILURES = 5
+PAGE_LOAD_TIMEOUT = 30
+DEBUG = False
+RESULT_TBODY_ID = 'resultListForm:resultTable_data'
+RESULT_ROW_LOCATOR = f'xpath://tbody[@id="{RESULT_TBODY_ID}"]/tr'
+# 解析只用得到HTML, 图片和字体不下载. 规则匹配的是完整URL, 结尾的 * 用来带上 ?ln=... 这类查询参数
+# (JSF 资源是 javax.faces.resource/xxx.png.jsf?ln=... 的形式, 也能匹配上)
+BLOCKED_URLS = ['*.png*', '*.jpg*', '*.jpeg*', '*.gif*', '*.svg*', '*.ico*', '*.woff*', '*.ttf*', '*.eot*']
+# 屏蔽样式表后 wait_results 的可见性判断和每页条数/下一页的点击还没在真实页面上验证过, 默认关闭
+BLOCK_STYLESHEETS = False
+if BLOCK_STYLESHEETS:
+    BLOCKED_URLS += ['*.css*', '*javax.faces.resource*.css*']
+DETAIL_BASE_URL = 'https://patentscope.wipo.int/search/zh/'
+FIELDNAMES = (
+    'name', 'data_rk', 'data_ri', 'ipc', 'pubdate', 'serial_number', 'detail_url',
+    'application_number', 'application_people', 'inventor', 'page', 'introduction',
+)
+
+# 每一行用到的选择器在导入时编译一次, 解析时直接作用在 lxml 元素上
+# 和原来的 .xpath('string(.)').get() 一样, 只取第一个匹配元素的完整文本
+def css_string(css):
+    return etree.XPath('string((%s)[1])' % GenericTranslator().css_to_xpath(css, prefix='descendant::'))
+
+def field_string(label):
+    return etree.XPath(f'string((.//span[contains(text(), "{label}")]/following-sibling::span)[1])')
+
+# 只取带 data-rk 的结果行; 没有结果时 PrimeFaces 渲染的 ui-datatable-empty-message 行不算
+XP_ROWS = etree.XPath(f'//tbody[@id="{RESULT_TBODY_ID}"]/tr[@data-rk]')
+XP_PAGE = etree.XPath('string(%s)' % GenericTranslator().css_to_xpath('.ps-paginator--page--value', prefix='descendant::'))
+XP_NAME = css_string('span.ps-patent-result--title--title.content--text-wrap')
+XP_DETAIL_URL = etree.XPath(GenericTranslator().css_to_xpath('div.ps-patent-result--first-row a', prefix='descendant::') + '/@href')
+XP_SERIAL_NUMBER = css_string('span.notranslate.ps-patent-result--title--record-number')
+XP_PUBDATE = css_string('div.ps-patent-result--title--ctr-pubdate')
+# IPC 在每行 resultListForm:resultTable:N:patentResult 这个 div 的 data-mt-ipc 属性上
+XP_IPC = etree.XPath('string((.//div[contains(@id, ":patentResult")]/@data-mt-ipc)[1])')
+XP_INTRODUCTION = etree.XPath('string((.//span[@class="trans-section needTranslation-biblio"])[1])')
+XP_APPLICATION_NUMBER = field_string('申请号')
+XP_APPLICATION_PEOPLE = field_string('申请人')
+XP_INVENTOR = field_string('发明人')
+
+# 选择器写错时不会报错, 只会得到空列; 整页某一列全空时提示一次
+warned_fields = set()
+
+def warn_empty_fields(data_list):
+    for i, field in enumerate(FIELDNAMES):
+        if field not in warned_fields and not any(row[i] for row in data_list):
+            warned_fields.add(field)
+            print(f'警告: 本页所有结果的 {field} 都为空, 请检查对应的选择器')
 
 def get_base_dir():
     if getattr(sys, 'frozen', False):
@@ -20,127 +80,345 @@ base_dir = os.path.dirname(current_dir)
 LOG_FILE = os.path.join(base_dir, 'wipo_ipcs_list_logs.txt')
 DATA_FILE = os.path.join(base_dir, 'wipo_data.csv')
 IPC_LIST_FILE = os.path.join(base_dir, 'wipo_ipcs_list.txt')
+DONE_FILE = os.path.join(base_dir, 'wipo_ipcs_done.txt')
 
-web = ChromiumPage()
+class BrowserPoolError(RuntimeError):
+    pass
 
-def get_last_ipc():
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'r') as f:
-            lines = f.readlines()
-            return lines[-1].strip().replace(' ', '') if lines else None
-    return None
+class CrawlStopped(Exception):
+    pass
 
-def initialize_web():
-    web.get(URL)
-    web.ele('@value=CLASSIF').click()
-    web.ele('#simpleSearchForm:fpSearch:input').input(get_last_ipc() or DEFAULT_IPC, clear=True)
-    web.ele('#simpleSearchForm:fpSearch:buttons').click()
-    time.sleep(5)
-    web.ele('@value=200', -1).click()
-    web.wait.load_start()
-    print('开始爬取')
+# Ctrl+C 时置位, 各线程爬完当前页就退出, 不用等整个IPC爬完
+stop_event = threading.Event()
+
+class BrowserPool:
+    """同一个浏览器里的一组标签页, 每个线程借用一个标签页爬一个IPC"""
+
+    def __init__(self, size=POOL_SIZE, recycle_after=TAB_RECYCLE_AFTER):
+        self.browser = ChromiumPage()
+        self.recycle_after = recycle_after
+        self.tabs = Queue()
+        for _ in range(size):
+            self.tabs.put(self._new_entry())
+
+    def _new_entry(self):
+        tab = self.browser.new_tab()
+        # DOMContentLoaded 就算加载完成, 结果是否就绪由 wait_results 判断
+        tab.set.load_mode.eager()
+        tab.run_cdp('Network.enable')
+        tab.run_cdp('Network.setBlockedURLs', urls=BLOCKED_URLS)
+        # used 记录这个标签页已经爬过多少个IPC, 为 0 时还没打开过搜索页
+        return {'tab': tab, 'used': 0}
+
+    def acquire(self):
+        try:
+            entry = self.tabs.get(timeout=POOL_ACQUIRE_TIMEOUT)
+        except Empty:
+            raise BrowserPoolError('等待空闲标签页超时') from None
+        if entry['tab'] is None:
+            # release 时没能重建的空位, 借出前再建一次
+            try:
+                entry = self._new_entry()
+            except Exception as e:
+                self.tabs.put(entry)
+                raise BrowserPoolError(f'无法新建标签页: {e!r}') from e
+        return entry
+
+    def release(self, entry, broken=False):
+        entry['used'] += 1
+        # 标签页用久了内存会涨, 出错后页面状态也不可信, 这两种情况都换新标签页
+        if broken or entry['used'] >= self.recycle_after:
+            self._close_tab(entry['tab'])
+            try:
+                entry = self._new_entry()
+            except Exception:
+                # 无论如何都要把空位放回去, 否则池子会越用越少直到所有线程卡死
+                entry = {'tab': None, 'used': 0}
+        self.tabs.put(entry)
+
+    def close(self):
+        while not self.tabs.empty():
+            self._close_tab(self.tabs.get()['tab'])
+
+    @staticmethod
+    def _close_tab(tab):
+        if tab is None:
+            return
+        try:
+            tab.close()
+        except Exception:
+            # 标签页或浏览器已经崩溃时关不掉, 直接丢弃
+            pass
+
+log_fh = None
+# 正在爬的IPC, 用 dict 当有序集合: 查找、删除都是 O(1), 顺序和日志文件一致
+log_ipcs = {}
+ipc_queue = deque()
+# 本轮已爬完的IPC, 每爬完一个就追加一行; 列表文件只在退出时重写, 被强杀时靠它过滤掉已完成的IPC
+done_fh = None
+done_ipcs = set()
+# IPC 在读入时统一去掉空白, 之后的比较和搜索都直接用规范化后的字符串
+SPACE_TABLE = str.maketrans('', '', ' \t\r\n')
+
+def normalize_ipcs(lines):
+    return (ipc_ for ipc_ in (line.translate(SPACE_TABLE) for line in lines) if ipc_)
+
+def load_state():
+    global log_fh, done_fh
+    # 日志和IPC列表只在启动时读取一次, 运行期间都在内存中维护
+    # a+ 模式文件不存在时会创建, 读完后这个句柄直接留作写日志用, 不需要再 stat 文件
+    log_fh = open(LOG_FILE, 'a+')
+    log_fh.seek(0)
+    done_fh = open(DONE_FILE, 'a+')
+    done_fh.seek(0)
+    done_ipcs.update(normalize_ipcs(done_fh))
+    log_ipcs.update(dict.fromkeys(ipc_ for ipc_ in normalize_ipcs(log_fh) if ipc_ not in done_ipcs))
+    try:
+        with open(IPC_LIST_FILE, 'r') as f:
+            ipc_queue.extend(ipc_ for ipc_ in normalize_ipcs(f) if ipc_ not in done_ipcs)
+    except FileNotFoundError:
+        pass
+    # 正常结束、异常退出或 Ctrl+C 都会走到 save_state, 剩余的IPC只在这时写回一次
+    atexit.register(save_state)
+
+def save_state():
+    global log_fh, done_fh
+    # 只在 load_state 之后执行一次, 避免用空队列覆盖IPC列表
+    if log_fh is None:
+        return
+    # 先写临时文件再替换, 中途崩溃也不会留下写了一半的列表
+    tmp = IPC_LIST_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(''.join(ipc_ + '\n' for ipc_ in ipc_queue))
+    os.replace(tmp, IPC_LIST_FILE)
+    # 列表里已经没有这些IPC了, 完成记录可以清空
+    done_fh.truncate(0)
+    done_fh.close()
+    done_fh = None
+    log_fh.close()
+    log_fh = None
+
+def first_row(tab):
+    return tab.ele(RESULT_ROW_LOCATOR, timeout=0)
+
+def wait_results(tab, old_row=None):
+    # 等旧的结果行被替换、新的结果行显示出来就继续, 不再固定 sleep
+    # 超时时 DrissionPage 默认返回 False 而不是报错, 这里必须报错, 否则会把旧页面当新页面再存一遍
+    if old_row and not old_row.wait.deleted(timeout=PAGE_LOAD_TIMEOUT):
+        raise TimeoutError('等待旧结果被替换超时')
+    if not tab.wait.ele_displayed(RESULT_ROW_LOCATOR, timeout=PAGE_LOAD_TIMEOUT):
+        raise TimeoutError('等待结果表格显示超时')
+
+def search_ipc(tab, ipc_, strategy='advanced'):
+    """classif: 新标签页从首页按分类号简单检索; advanced: 在已有结果页的高级检索框里换IPC"""
+    if strategy == 'classif':
+        tab.get(URL)
+        tab.ele('@value=CLASSIF').click()
+        tab.ele('#simpleSearchForm:fpSearch:input').input(ipc_, clear=True)
+        tab.ele('#simpleSearchForm:fpSearch:buttons').click()
+        wait_results(tab)
+        # 每页条数是会话设置, 每个标签页只需要改一次
+        old_row = first_row(tab)
+        tab.ele(f'@value={PAGE_LIMIT}', -1).click()
+    elif strategy == 'advanced':
+        old_row = first_row(tab)
+        search_box = tab.ele('#advancedSearchForm:advancedSearchInput:input')
+        search_box.input('IC:(' + ipc_ + ')', clear=True, by_js=True)
+        search_box.parent().ele('button[type="submit"]').click()
+    else:
+        raise ValueError(f'未知的检索方式: {strategy}')
+    wait_results(tab, old_row)
+
+def crawl_ipc(pool, ipc_):
+    entry = pool.acquire()
+    tab = entry['tab']
+    broken = True
+    try:
+        search_ipc(tab, ipc_, 'classif' if entry['used'] == 0 else 'advanced')
+        doc = lxml.html.fromstring(tab.html)
+        while True:
+            # 处理当前页面
+            current_page = handle_data(doc)
+            print(f"{ipc_} 处理完成: {current_page}")
+            if stop_event.is_set():
+                # 标签页本身没问题, 不用换; 这个IPC留在日志里下次续爬
+                broken = False
+                raise CrawlStopped(ipc_)
+
+            # 检查是否有下一页
+            next_btn = tab.ele('xpath://a[@aria-label="下一页"]', timeout=5)
+            if not next_btn:
+                break
+            old_row = first_row(tab)
+            next_btn.click()
+            wait_results(tab, old_row)
+            doc = lxml.html.fromstring(tab.html)
+        broken = False
+    finally:
+        pool.release(entry, broken)
 
 def add_to_logs(ipc_):
-    with open(LOG_FILE, 'a') as f:
-        f.write(ipc_ + '\n')
+    log_ipcs[ipc_] = None
+    log_fh.write(ipc_ + '\n')
+    log_fh.flush()
+
+def mark_done(ipc_):
+    done_ipcs.add(ipc_)
+    done_fh.write(ipc_ + '\n')
+    done_fh.flush()
 
 def remove_from_logs(ipc_):
-    if not os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'w') as f:
-            f.write('')
-    with open(LOG_FILE, 'r') as f:
-        lines = f.readlines()
-    with open(LOG_FILE, 'w') as f:
-        f.writelines([line for line in lines if line.strip() != ipc_])
+    # 不在日志里的IPC(比如默认IPC)不用重写文件
+    if ipc_ not in log_ipcs:
+        return
+    del log_ipcs[ipc_]
+    log_fh.truncate(0)
+    log_fh.writelines(line + '\n' for line in log_ipcs)
+    log_fh.flush()
 
 def pop_from_list():
-    if os.path.exists(IPC_LIST_FILE):
-        with open(IPC_LIST_FILE, 'r') as f:
-            lines = f.readlines()
-        if lines:
-            ipc_ = lines[0].strip()
-            with open(IPC_LIST_FILE, 'w') as f:
-                f.writelines(lines[1:])
+    while ipc_queue:
+        ipc_ = ipc_queue.popleft()
+        if ipc_ not in log_ipcs:
             return ipc_
     return None
 
-def handle_data(html):
-    text = Selector(html)
-    eles = text.xpath('//tbody[@id="resultListForm:resultTable_data"]/tr')
-    print(f'大小 {len(eles)}')
-    try:
-        page = text.css('.ps-paginator--page--value').xpath('string(.)').get().strip()
-    except:
-        page = "没有数据"
+def handle_data(doc):
+    rows = XP_ROWS(doc)
+    if DEBUG:
+        print(f'大小 {len(rows)}')
+    # 没有分页控件时 string() 返回空字符串
+    page = XP_PAGE(doc).strip() or "没有数据"
     
     data_list = []
-    for ele in eles:
-        # 解析数据的代码保持不变...
-        # ...（此处省略解析代码，与原代码相同）
-        
-        data_dict = {
-            'name': name,
-            'data_rk': data_rk,
-            'data_ri': data_ri,
-            'ipc': ipc,
-            'pubdate': pubdate,
-            'serial_number': serial_number,
-            'detail_url': detail_url,
-            'application_number': application_number,
-            'application_people': application_people,
-            'inventor': inventor,
-            'page': page,
-            'introduction': introduction
-        }
-        data_list.append(data_dict)
+    for row in rows:
+        name = XP_NAME(row).strip()
+        data_rk = row.get('data-rk', '')
+        data_ri = row.get('data-ri', '')
+        ipc = XP_IPC(row).strip()
+        pubdate = XP_PUBDATE(row).strip()
+        serial_number = XP_SERIAL_NUMBER(row).strip()
+        href = XP_DETAIL_URL(row)
+        detail_url = DETAIL_BASE_URL + href[0] if href else ''
+        application_number = XP_APPLICATION_NUMBER(row).strip()
+        application_people = XP_APPLICATION_PEOPLE(row).strip()
+        inventor = XP_INVENTOR(row).strip()
+        introduction = XP_INTRODUCTION(row).strip()
+
+        # 按 FIELDNAMES 的顺序组装一行
+        data_list.append((
+            name, data_rk, data_ri, ipc, pubdate, serial_number, detail_url,
+            application_number, application_people, inventor, page, introduction,
+        ))
     
+    if data_list:
+        warn_empty_fields(data_list)
     save_data_to_file(data_list)
     return page
 
+csv_fh = None
+csv_writer = None
+data_buffer = []
+# 多个标签页线程共用同一个文件和缓冲区
+data_lock = threading.Lock()
+data_closed = False
+
 def save_data_to_file(data_list):
     if not data_list:
         return
-    file_exists = os.path.exists(DATA_FILE)
-    fieldnames = data_list[0].keys()
-    
-    with open(DATA_FILE, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerows(data_list)
+    with data_lock:
+        _buffer_data(data_list)
+
+def _buffer_data(data_list):
+    global csv_fh, csv_writer
+    # 中断退出后还在跑的线程交上来的数据直接丢掉, 对应的IPC还在日志里, 下次会重爬
+    if data_closed:
+        return
+    if csv_writer is None:
+        # 整个运行期间只打开一次文件, 文件为空时才写表头
+        csv_fh = open(DATA_FILE, 'a', newline='', encoding='utf-8', buffering=1 << 20)
+        csv_writer = csv.writer(csv_fh)
+        if csv_fh.tell() == 0:
+            csv_writer.writerow(FIELDNAMES)
+    data_buffer.extend(data_list)
+    if len(data_buffer) >= SAVE_BATCH_SIZE:
+        _flush_data()
+
+def flush_data():
+    with data_lock:
+        _flush_data()
+
+def _flush_data():
+    if data_buffer:
+        csv_writer.writerows(data_buffer)
+        data_buffer.clear()
+    if csv_fh:
+        csv_fh.flush()
+
+def close_data_file():
+    global csv_fh, csv_writer, data_closed
+    with data_lock:
+        _flush_data()
+        if csv_fh:
+            csv_fh.close()
+        csv_fh = None
+        csv_writer = None
+        data_closed = True
+
+def next_ipc(resumed):
+    # 先续爬上次没爬完的IPC, 再从列表里取新的
+    if resumed:
+        return resumed.popleft()
+    ipc_ = pop_from_list()
+    if ipc_:
+        print(f'读取新IPC: {ipc_}')
+        add_to_logs(ipc_)
+    return ipc_
 
 if __name__ == '__main__':
-    initialize_web()
-    
-    ipc_ = get_last_ipc() or DEFAULT_IPC
-    while True:
-        # 处理当前页面
-        current_html = web.html
-        current_page = handle_data(current_html)
-        print(f"处理完成: {current_page}")
-        
-        # 检查是否有下一页
-        next_btn = web.ele('xpath://a[@aria-label="下一页"]', timeout=5)
-        if next_btn:
-            next_btn.click()
-            web.wait.load_start()
-            time.sleep(2)
-        else:
-            # 切换IPC
-            print(f'移除IPC: {ipc_}')
-            remove_from_logs(ipc_)
-            ipc_ = pop_from_list()
-            if not ipc_:
+    load_state()
+    resumed = deque(log_ipcs or [DEFAULT_IPC])
+    pool = BrowserPool()
+    print('开始爬取')
+    executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+    try:
+        running = {}
+        failures = 0
+        while True:
+            while len(running) < POOL_SIZE:
+                ipc_ = next_ipc(resumed)
+                if not ipc_:
+                    break
+                running[executor.submit(crawl_ipc, pool, ipc_)] = ipc_
+            if not running:
                 print("没有更多IPC，结束爬取")
                 break
-            
-            print(f'读取新IPC: {ipc_}')
-            add_to_logs(ipc_)
-            # 重新输入IPC进行搜索
-            search_box = web.ele('#advancedSearchForm:advancedSearchInput:input')
-            search_box.input('IC:(' + ipc_.replace(' ', '') + ')', clear=True, by_js=True)
-            search_box.parent().ele('button[type="submit"]').click()
-            web.wait.load_start()
-            time.sleep(5)
-            
-        time.sleep(2)
+            # 带超时等待, Windows 上无超时的等待收不到 Ctrl+C
+            done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                ipc_ = running.pop(future)
+                if isinstance(future.exception(), BrowserPoolError):
+                    # 浏览器不可用, 继续取IPC只会全部失败
+                    raise future.exception()
+                if future.exception():
+                    # 出错的IPC留在日志里, 下次启动时续爬
+                    print(f'爬取IPC出错: {ipc_} {future.exception()!r}')
+                    failures += 1
+                    if failures >= MAX_CONSECUTIVE_FAILURES:
+                        raise RuntimeError(f'连续 {failures} 个IPC爬取失败, 停止运行') from future.exception()
+                    continue
+                failures = 0
+                # 移除IPC前先把缓冲的数据落盘, 保证已记录为完成的IPC数据不丢
+                flush_data()
+                mark_done(ipc_)
+                print(f'移除IPC: {ipc_}')
+                remove_from_logs(ipc_)
+    except KeyboardInterrupt:
+        print('收到中断, 保存进度后退出')
+    finally:
+        # 不等还在跑的IPC爬完, 它们会在当前页结束后自行退出
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        close_data_file()
+        save_state()
+        pool.close()